@@ -24,19 +24,20 @@
 # Standard python3 modules
 import argparse
 import binascii
+import collections
+import concurrent.futures
+import errno
 import json
 import os
 import re
-import select
+import selectors
+import socket
+import statistics
 import struct
 import sys
-
-# Non-standard modules
-try:
-    import serial
-except ImportError:
-    print('Cannot import "serial". Please sudo apt-get install python3-serial')
-    sys.exit(1)
+import termios
+import threading
+import time
 
 
 class USBList(object):
@@ -45,6 +46,7 @@ class USBList(object):
     '''
 
     SYSPATH = '/sys/bus/usb/devices'
+    CLASSPATH = '/sys/class'
 
     def _readfile(self, path):
         '''Read data from 'path' and return it as a string. Return the empty string
@@ -71,11 +73,48 @@ class USBList(object):
                 devices.add(entry.name)
         return devices
 
-    def _get_usb_device(self, dirname):
+    def _usb_device_name(self, path):
+        '''Return the name of the USB device (e.g. "1-1.2") that 'path', a path
+        in the /sys hierarchy, belongs to, or None. Interfaces ("1-1.2:1.0")
+        and root hubs ("usb1") are not USB devices in this sense.
+        '''
+        for name in reversed(path.split('/')):
+            if re.match(r'^[0-9]+-[0-9.]+$', name):
+                return name
+        return None
+
+    def get_class_devices(self):
+        '''Map each USB device name to the set of hidraw and tty devices that
+        belong to it, using the links in /sys/class rather than walking every
+        USB device.
+        '''
+        devices = collections.defaultdict(set)
+        for subsystem in ['hidraw', 'tty']:
+            try:
+                entries = list(os.scandir(os.path.join(self.CLASSPATH,
+                                                       subsystem)))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    target = os.readlink(entry.path)
+                except OSError:
+                    continue
+                name = self._usb_device_name(target)
+                if name is not None:
+                    devices[name].add(entry.name)
+        return devices
+
+    def _get_usb_device(self, dirname, is_known=None, class_devices=None):
         '''Examine the files in 'dirname', looking for files with well-known
         names expected to be in the /sys hierarchy under Linux for USB devices.
         Return a dictionary of the information gathered. If no information is found
         (i.e., because the directory is not for a USB device) return None.
+
+        If 'is_known' is not None, it is called with the vendor and product
+        ids, and None is returned unless it returns True. If 'class_devices'
+        is not None, it is used to find the hidraw and tty devices (see
+        'get_class_devices'); otherwise 'dirname' is searched for them.
         '''
         info = dict()
         vendorid = self._readfile(os.path.join(dirname, 'idVendor'))
@@ -84,61 +123,842 @@ class USBList(object):
         info['vendorid'] = int(vendorid, 16)
         productid = self._readfile(os.path.join(dirname, 'idProduct'))
         info['productid'] = int(productid, 16)
+        if is_known is not None and \
+           not is_known(info['vendorid'], info['productid']):
+            return None
         info['manufacturer'] = self._readfile(os.path.join(dirname,
                                                            'manufacturer'))
         info['product'] = self._readfile(os.path.join(dirname, 'product'))
         info['busnum'] = int(self._readfile(os.path.join(dirname, 'busnum')))
         info['devnum'] = int(self._readfile(os.path.join(dirname, 'devnum')))
-        info['devices'] = sorted(self._find_devices(dirname))
+        if class_devices is not None:
+            info['devices'] = sorted(
+                class_devices.get(os.path.basename(dirname), ()))
+        else:
+            info['devices'] = sorted(self._find_devices(dirname))
         return info
 
-    def get_usb_devices(self):
+    def get_usb_device(self, dirname, is_known=None, class_devices=None):
+        '''Return information about the USB device in 'dirname', as for
+        'get_usb_devices', or None. When looking at several devices, pass the
+        result of 'get_class_devices' as 'class_devices', so that it is only
+        built once.
+        '''
+        if class_devices is None and is_known:
+            class_devices = self.get_class_devices()
+        return self._get_usb_device(dirname, is_known, class_devices)
+
+    def get_usb_devices(self, is_known=None):
         '''Scan a well-known Linux hierarchy in /sys and try to find all of the
         USB devices on a system. Return these as a dictionary indexed by the path.
+
+        If 'is_known' is not None, only devices for which is_known(vendorid,
+        productid) returns True are included. Only their ids are read for
+        other devices, and hidraw and tty devices are found through /sys/class
+        rather than by searching each USB device.
         '''
         info = dict()
+        class_devices = self.get_class_devices() if is_known else None
         for entry in os.scandir(Temper.SYSPATH):
+            if is_known is not None and ':' in entry.name:
+                continue        # skip interfaces
             if entry.is_dir():
                 path = os.path.join(Temper.SYSPATH, entry.name)
-                device = self._get_usb_device(path)
+                device = self._get_usb_device(path, is_known, class_devices)
                 if device is not None:
                     info[path] = device
         return info
 
 
-class USBRead(object):
-    '''Read temperature and/or humidity information from a specified USB device.
+class LatencyEstimate(object):
+    '''A moving estimate of how long a device takes to reply, used to decide how
+    long to wait for it. The estimate is taken from the last WINDOW replies,
+    and is not used until there have been at least MIN_SAMPLES of them.
     '''
 
-    def __init__(self, device, verbose=False):
-        self.device = device
-        self.verbose = verbose
+    WINDOW = 100
+    MIN_SAMPLES = 5
+
+    # The timeout is the 99th percentile latency, times FACTOR, plus MARGIN,
+    # but no less than MIN_TIMEOUT and no more than MAX_TIMEOUT (in seconds).
+    PERCENTILE = 0.99
+    FACTOR = 1.5
+    MARGIN = 0.01
+    MIN_TIMEOUT = 0.02
+    MAX_TIMEOUT = 1.0
+
+    def __init__(self):
+        self.samples = collections.deque(maxlen=self.WINDOW)
+
+    def add(self, latency):
+        '''Record a reply which took 'latency' seconds.
+        '''
+        self.samples.append(latency)
+
+    def timeout(self, default):
+        '''Return how long to wait for a reply, or 'default' if too little is
+        known yet.
+        '''
+        samples = sorted(self.samples)
+        if len(samples) < self.MIN_SAMPLES:
+            return default
+        latency = samples[min(len(samples) - 1,
+                              int(len(samples) * self.PERCENTILE))]
+        return min(self.MAX_TIMEOUT,
+                   max(self.MIN_TIMEOUT, latency * self.FACTOR + self.MARGIN))
+
+
+class CircuitBreaker(object):
+    '''The health of a device. After THRESHOLD consecutive failed reads the
+    circuit opens, and the device is quarantined: it is left alone, apart
+    from an occasional probe to see whether it has recovered. The first probe
+    is due MIN_BACKOFF seconds after the circuit opens, and the wait doubles
+    after each failed probe, up to MAX_BACKOFF seconds. A successful read
+    closes the circuit.
+    '''
+
+    THRESHOLD = 3
+    MIN_BACKOFF = 5
+    MAX_BACKOFF = 300
+
+    def __init__(self):
+        self.failures = 0
+        self.backoff = 0
+        # When the next probe is due
+        self.retry = None
+        self.lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self.failures >= self.THRESHOLD
+
+    def succeeded(self):
+        '''Record a successful read.
+        '''
+        with self.lock:
+            self.failures = 0
+            self.backoff = 0
+            self.retry = None
+
+    def failed(self):
+        '''Record a failed read.
+        '''
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.THRESHOLD:
+                self.backoff = min(self.MAX_BACKOFF,
+                                   self.backoff * 2 or self.MIN_BACKOFF)
+                self.retry = time.monotonic() + self.backoff
+
+    def probe(self):
+        '''Return True if the circuit is open and a probe is due, in which case
+        the caller should make it. The next probe is put off by the current
+        backoff, so that only one caller makes each probe.
+        '''
+        with self.lock:
+            if not self.open or time.monotonic() < self.retry:
+                return False
+            self.retry = time.monotonic() + self.backoff
+            return True
+
+
+class DeviceSession(object):
+    '''Per-device state which is kept between reads. Sessions are identified by
+    the sysfs path of the USB device they belong to, together with its bus and
+    device numbers, which change whenever the device is re-enumerated.
+
+    The device is kept open. If it goes away, the file descriptor is closed
+    and reopened on next use. Serial (tty) devices are configured for 9600
+    baud, 8 data bits, no parity, 1 stop bit and no flow control when opened.
+    Hidraw devices are opened non-blocking, so that stale reports can be
+    drained before each command.
+
+    The firmware identifier is cached in 'firmware', so that it only needs to
+    be queried once per attachment. How quickly the device replies is tracked
+    in 'latency', a LatencyEstimate, and whether it replies at all in
+    'breaker', a CircuitBreaker.
+    '''
 
-    def _parse_bytes(self, name, offset, divisor, bytes, info):
-        '''Data is returned from several devices in a similar format. In the first
-        8 bytes, the internal sensors are returned in bytes 2 and 3 (temperature)
-        and in bytes 4 and 5 (humidity). In the second 8 bytes, external sensor
-        information is returned. If there are only external sensors, then only 8
-        bytes are returned, and the caller is expected to use the correct 'name'.
-        The caller is also expected to detect the firmware version and provide the
-        appropriate divisor, which is usually 100 or 256.
+    # Big enough for the longest reply from any device
+    BUFFER_SIZE = 256
 
-        There is no return value. Instead 'info[name]' is update directly, if a
-        value is found.
+    def __init__(self, path, device, busnum=None, devnum=None):
+        self.path = path
+        self.device = device
+        self.identity = (device, busnum, devnum)
+        self.fd = None
+        self.firmware = None
+        self.latency = LatencyEstimate()
+        self.breaker = CircuitBreaker()
+        # Replies from the device are read into this
+        self.buffer = bytearray(self.BUFFER_SIZE)
+        self.discarded = False
+        # Held for the duration of each read of the device
+        self.lock = threading.Lock()
+        # The result of the read in progress, if any; see 'shared'
+        self.inflight = None
+        self.inflight_lock = threading.Lock()
+
+    def fileno(self):
+        '''Return the file descriptor for the device, opening it if necessary.
+        '''
+        if self.discarded:
+            raise FileNotFoundError(errno.ENOENT, 'Device has gone away',
+                                    self.device)
+        if self.fd is None:
+            path = os.path.join('/dev', self.device)
+            if self.device.startswith('tty'):
+                # Open without blocking, which could otherwise wait for
+                # carrier detect until CLOCAL is set.
+                fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+                try:
+                    self._configure_tty(fd)
+                except termios.error as e:
+                    os.close(fd)
+                    raise OSError(*e.args)
+                os.set_blocking(fd, True)
+                self.fd = fd
+            else:
+                self.fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        return self.fd
+
+    def _configure_tty(self, fd):
+        # Raw mode, 9600 8N1, no flow control
+        attrs = termios.tcgetattr(fd)
+        attrs[0] = 0                                                # iflag
+        attrs[1] = 0                                                # oflag
+        attrs[2] = termios.CS8 | termios.CREAD | termios.CLOCAL     # cflag
+        attrs[3] = 0                                                # lflag
+        attrs[4] = attrs[5] = termios.B9600                         # speeds
+        attrs[6][termios.VMIN] = 0
+        attrs[6][termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+
+    def close(self):
+        '''Close the device. It will be reopened by the next call to 'fileno'.
+        '''
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+    def discard(self):
+        '''Close the device for good, waiting for any read in progress to
+        finish first.
+        '''
+        with self.lock:
+            self.discarded = True
+            self.close()
+
+    def shared(self, fn, timeout):
+        '''Call 'fn' and return its result. If a call is already in progress for
+        this session then wait up to 'timeout' seconds for it to finish and
+        share its result (or exception) instead, so that concurrent callers
+        cause only one read of the device. Raises
+        concurrent.futures.TimeoutError if the wait times out.
+        '''
+        with self.inflight_lock:
+            future = self.inflight
+            if future is not None:
+                leader = False
+            else:
+                leader = True
+                future = self.inflight = concurrent.futures.Future()
+        if not leader:
+            return future.result(timeout)
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.inflight_lock:
+                self.inflight = None
+
+    def run(self, fn):
+        '''Call 'fn' with the open file descriptor and return its result. If the
+        device reports ENODEV or EIO (e.g. because it has been unplugged and
+        replugged) then it is reopened and 'fn' is called once more.
         '''
         try:
-            if bytes[offset] == 0x4e and bytes[offset+1] == 0x20:
+            return fn(self.fileno())
+        except OSError as e:
+            if e.errno not in (errno.ENODEV, errno.EIO):
+                raise
+        # The device may have been replaced, so forget what we knew about it
+        self.close()
+        self.firmware = None
+        self.latency = LatencyEstimate()
+        return fn(self.fileno())
+
+
+class SessionPool(object):
+    '''The open device sessions for a process, indexed by sysfs path.
+    '''
+
+    def __init__(self):
+        self.sessions = dict()
+        self.lock = threading.Lock()
+
+    def get(self, path, info):
+        '''Return the session for the device at 'path', creating it if needed.
+        'info' is the device information from USBList. If the device node, bus
+        number or device number have changed then the old session is discarded.
+        '''
+        device = info['devices'][-1]
+        identity = (device, info['busnum'], info['devnum'])
+        stale = None
+        with self.lock:
+            session = self.sessions.get(path)
+            if session is None or session.identity != identity:
+                stale = session
+                session = DeviceSession(path, *identity)
+                self.sessions[path] = session
+        if stale is not None:
+            stale.discard()
+        return session
+
+    def prune(self, paths):
+        '''Close and discard sessions for devices not in 'paths'.
+        '''
+        with self.lock:
+            stale = [self.sessions.pop(path) for path in list(self.sessions)
+                     if path not in paths]
+        for session in stale:
+            session.discard()
+
+
+class Transaction(object):
+    '''A command written to a device, and the reply to it. The reply is
+    collected in 8-byte reports until 'length' bytes have arrived, or until
+    nothing arrives for 'timeout' seconds. If 'length' is None then only the
+    timeout ends the reply.
+
+    Before the command is written, anything left over from earlier commands
+    is read and discarded. If 'match' is not None, it is called with each
+    report, and reports for which it returns False are discarded too. The
+    number of bytes discarded is recorded in 'discarded'.
+
+    The longest wait for the device, either for the first report after the
+    command or between reports, is recorded in 'latency'. It is None if
+    nothing arrived.
+
+    The reply is read directly into 'buffer', a bytearray, which can be reused
+    from one transaction to the next; it also limits the length of the reply.
+    The reply is delivered through 'future', as a memoryview of the buffer, so
+    it is only valid until the buffer is reused. A transaction can either be
+    submitted to a Reactor or performed in the calling thread with 'run'.
+    '''
+
+    # The default buffer size
+    BUFFER_SIZE = 64
+
+    # The most reads made when draining the device; the kernel queues up to
+    # 64 reports for each hidraw device.
+    DRAIN_LIMIT = 64
+
+    def __init__(self, fd, command, length, timeout, buffer=None, match=None):
+        self.fd = fd
+        self.command = command
+        self.length = length
+        self.timeout = timeout
+        self.match = match
+        self.discarded = 0
+        if buffer is None:
+            buffer = bytearray(self.BUFFER_SIZE)
+        self.buffer = memoryview(buffer)
+        self.size = 0
+        self.deadline = None
+        self.latency = None
+        # When the command was sent or the last report arrived
+        self.last = None
+        self.future = concurrent.futures.Future()
+
+    @property
+    def reply(self):
+        '''The reply received so far.
+        '''
+        return self.buffer[:self.size]
+
+    def start(self):
+        '''Write the command to the device.
+        '''
+        self._drain()
+        os.write(self.fd, self.command)
+        self.last = time.monotonic()
+        self.deadline = self.last + self.timeout
+
+    def _drain(self):
+        # Discard whatever is waiting to be read, without blocking
+        for i in range(self.DRAIN_LIMIT):
+            try:
+                n = os.readv(self.fd, [self.buffer])
+            except BlockingIOError:
                 return
-        except:
-            return
+            if n == 0:
+                return
+            self.discarded += n
+
+    def _received(self):
+        # Note how long the report took, and wait for the next one
+        now = time.monotonic()
+        self.latency = max(self.latency or 0, now - self.last)
+        self.last = now
+        self.deadline = now + self.timeout
+
+    def readable(self):
+        '''Read a report from the device. Returns True if the reply is complete.
+        '''
+        report = self.buffer[self.size:self.size + 8]
+        n = os.readv(self.fd, [report])
+        if n and self.match is not None and not self.match(report[:n]):
+            # Not a reply to this command
+            self.discarded += n
+            return False
+        self.size += n
+        self._received()
+        if self.size == len(self.buffer):
+            return True
+        return self.length is not None and self.size >= self.length
+
+    def run(self):
+        '''Perform the transaction in the calling thread and return the reply.
+        '''
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.fd, selectors.EVENT_READ)
+            self.start()
+            while selector.select(max(0, self.deadline - time.monotonic())):
+                if self.readable():
+                    break
+        return self.reply
+
+
+class PipelinedTransaction(Transaction):
+    '''Several commands written back to back, whose replies are told apart by
+    their content: replies to the firmware query are ASCII text, whereas data
+    reports have the top bit of their first byte set. The reply is a tuple of
+    the firmware identifier (as bytes) and a view of the data in the buffer.
+
+    The reply is complete once 'firmware_length' bytes of firmware and the
+    amount of data expected for that firmware have arrived; 'data_length' is
+    called with the firmware identifier to find the latter.
+    '''
+
+    def __init__(self, fd, commands, firmware_length, data_length, timeout,
+                 buffer=None):
+        super().__init__(fd, commands, None, timeout, buffer)
+        self.firmware = bytearray()
+        self.firmware_length = firmware_length
+        self.data_length = data_length
+
+    @property
+    def reply(self):
+        return bytes(self.firmware), self.buffer[:self.size]
+
+    def start(self):
+        self._drain()
+        for command in self.command:
+            os.write(self.fd, command)
+        self.last = time.monotonic()
+        self.deadline = self.last + self.timeout
+
+    def readable(self):
+        report = self.buffer[self.size:self.size + 8]
+        n = os.readv(self.fd, [report])
+        self._received()
+        if n and not report[0] & 0x80:
+            self.firmware += report[:n]
+        else:
+            self.size += n
+        if self.size == len(self.buffer):
+            return True
+        if len(self.firmware) < self.firmware_length:
+            return False
+        length = self.data_length(bytes(self.firmware))
+        return length is not None and self.size >= length
+
+
+class SerialTransaction(Transaction):
+    '''A command written to a serial device, and its reply. The reply is
+    complete as soon as it matches 'complete', a compiled regular expression.
+    Unlike other transactions, 'timeout' is a deadline for the whole reply,
+    measured from when the command was sent.
+
+    Some replies may or may not have more to come. Once the reply matches
+    'partial' (if not None), it is also considered complete when nothing
+    further arrives for 'idle' seconds.
+    '''
+
+    def __init__(self, fd, command, complete, timeout, buffer=None,
+                 partial=None, idle=0.05):
+        super().__init__(fd, command, None, timeout, buffer)
+        self.complete = complete
+        self.partial = partial
+        self.idle = idle
+        self.end = None
+
+    def readable(self):
+        self.size += os.readv(self.fd, [self.buffer[self.size:]])
+        if self.size == len(self.buffer):
+            return True
+        reply = self.buffer[:self.size]
+        if self.complete.search(reply):
+            return True
+        if self.end is None:
+            self.end = self.deadline
+        if self.partial is not None and self.partial.search(reply):
+            self.deadline = min(self.end, time.monotonic() + self.idle)
+        return False
+
+
+class Reactor(object):
+    '''A single thread which performs the I/O for all open devices. The reactor
+    writes the command for each submitted Transaction, waits for replies from
+    all of the devices with one selector (epoll, where available), and
+    completes each transaction's future when its reply is complete or the
+    device goes idle.
+
+    Only one transaction is outstanding for each file descriptor; others are
+    queued behind it. The thread is started on first use.
+
+    The reactor also feeds any data from a USBStream's device to the stream,
+    until the stream is stopped or the device goes away.
+    '''
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        # Streams to be started or stopped, as (stream, listen) pairs
+        self.changes = collections.deque()
+        self.active = dict()
+        self.waiting = collections.defaultdict(collections.deque)
+        self.streams = dict()
+        self.wakeup = os.pipe()
+        os.set_blocking(self.wakeup[0], False)
+        self.selector.register(self.wakeup[0], selectors.EVENT_READ)
+        self.thread = None
+
+    def submit(self, transaction):
+        '''Queue 'transaction' and return its future.
+        '''
+        with self.lock:
+            self.queue.append(transaction)
+            self._wake()
+        return transaction.future
+
+    def listen(self, stream):
+        '''Start feeding data from the device of 'stream' to it.
+        '''
+        with self.lock:
+            self.changes.append((stream, True))
+            self._wake()
+
+    def unlisten(self, stream):
+        '''Stop feeding data to 'stream', and close it.
+        '''
+        with self.lock:
+            self.changes.append((stream, False))
+            self._wake()
+
+    def _wake(self):
+        # Called with the lock held
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,
+                                           name='reactor', daemon=True)
+            self.thread.start()
+        os.write(self.wakeup[1], b'\0')
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self.active:
+                timeout = max(0, min(t.deadline for t in self.active.values())
+                              - time.monotonic())
+            for key, _ in self.selector.select(timeout):
+                if key.fd == self.wakeup[0]:
+                    self._accept()
+                elif key.fd in self.active:
+                    self._readable(self.active[key.fd])
+                elif key.fd in self.streams:
+                    self._feed(self.streams[key.fd])
+            now = time.monotonic()
+            for transaction in [t for t in self.active.values()
+                                if t.deadline <= now]:
+                self._finish(transaction)
+
+    def _accept(self):
+        # Collect newly submitted transactions
         try:
-            info[name] = struct.unpack_from('>h', bytes, offset)[0] / divisor
-        except:
+            while os.read(self.wakeup[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self.lock:
+            transactions = list(self.queue)
+            self.queue.clear()
+            changes = list(self.changes)
+            self.changes.clear()
+        for stream, listen in changes:
+            if listen:
+                self.selector.register(stream.fd, selectors.EVENT_READ)
+                self.streams[stream.fd] = stream
+            elif self.streams.get(stream.fd) is stream:
+                self._unlisten(stream)
+            else:
+                stream.close()
+        for transaction in transactions:
+            if transaction.fd in self.active:
+                self.waiting[transaction.fd].append(transaction)
+            else:
+                self._start(transaction)
+
+    def _start(self, transaction):
+        try:
+            transaction.start()
+        except OSError as e:
+            transaction.future.set_exception(e)
+            self._next(transaction.fd)
             return
+        self.selector.register(transaction.fd, selectors.EVENT_READ)
+        self.active[transaction.fd] = transaction
 
-    def _read_hidraw_firmware(self, fd, verbose=False):
+    def _readable(self, transaction):
+        try:
+            if transaction.readable():
+                self._finish(transaction)
+        except OSError as e:
+            self._finish(transaction, e)
+
+    def _finish(self, transaction, error=None):
+        self.selector.unregister(transaction.fd)
+        del self.active[transaction.fd]
+        if error is None:
+            transaction.future.set_result(transaction.reply)
+        else:
+            transaction.future.set_exception(error)
+        self._next(transaction.fd)
+
+    def _feed(self, stream):
+        try:
+            stream.readable()
+        except OSError as e:
+            stream.error = str(e)
+            self._unlisten(stream)
+
+    def _unlisten(self, stream):
+        self.selector.unregister(stream.fd)
+        del self.streams[stream.fd]
+        stream.close()
+
+    def _next(self, fd):
+        # Start the next transaction queued for 'fd', if any
+        waiting = self.waiting.get(fd)
+        if waiting:
+            self._start(waiting.popleft())
+            if not waiting:
+                del self.waiting[fd]
+
+
+class Decoder(object):
+    '''How to decode the data returned by a family of hidraw devices.
+
+    Data is returned in 8-byte frames. Each frame holds a temperature in bytes
+    2 and 3 and a humidity in bytes 4 and 5, as big-endian signed values which
+    must be divided by 'divisor'. Usually the first frame is for the internal
+    sensors and the second for external sensors. 'channels' lists the names
+    of the (temperature, humidity) pair in each frame, with None for values
+    the device does not provide.
+
+    'prefix' identifies the family from its firmware identifier, the first
+    'name_length' characters of which are reported as the firmware.
+    '''
+
+    FRAME = struct.Struct('>2xhh2x')
+
+    # The value returned for a sensor which is not present
+    MISSING = 0x4e20
+
+    def __init__(self, prefix, name_length, divisor, channels):
+        self.prefix = prefix
+        self.name_length = name_length
+        self.divisor = divisor
+        self.channels = channels
+        # The expected length of the data
+        self.length = self.FRAME.size * len(channels)
+
+    def decode(self, data, info):
+        '''Decode 'data' and add the values found to 'info'.
+        '''
+        for offset, names in zip(range(0, len(data) - self.FRAME.size + 1,
+                                       self.FRAME.size),
+                                 self.channels):
+            for name, value in zip(names, self.FRAME.unpack_from(data, offset)):
+                if name is not None and value != self.MISSING:
+                    info[name] = value / self.divisor
+
+
+class DecoderRegistry(object):
+    '''A collection of Decoder objects, looked up by firmware identifier.
+    '''
+
+    def __init__(self, decoders):
+        self.decoders = {decoder.prefix: decoder for decoder in decoders}
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.decoders},
+                                     reverse=True)
+
+    def find(self, firmware):
+        '''Return the Decoder for 'firmware' (a string), or None.
+        '''
+        for length in self.prefix_lengths:
+            decoder = self.decoders.get(firmware[:length])
+            if decoder is not None:
+                return decoder
+        return None
+
+
+class USBRead(object):
+    '''Read temperature and/or humidity information from a specified USB device.
+    If 'session' is supplied, it is used for hidraw devices, and left open after
+    reading; otherwise the device is opened and closed for each read. If
+    'reactor' is supplied, hidraw I/O is performed by the reactor thread;
+    otherwise it is performed by the calling thread.
+
+    If 'pipeline' is True, then when the firmware identifier is not yet known
+    the firmware and data queries are sent together, rather than waiting for
+    the reply to one before sending the other.
+
+    If 'samples' is more than 1, then hidraw devices are asked for that many
+    readings in a row, and the values reported are combined from them; see
+    '_combine'.
+
+    How long to wait for a hidraw device is learned from the session's latency
+    estimate; the fixed timeouts given below are used until it is ready.
+    '''
+
+    # The firmware identifier is returned as two 8-byte reports of ASCII text,
+    # whereas data reports have the top bit of their first byte set.
+    FIRMWARE_QUERY = struct.pack('8B', 0x01, 0x86, 0xff, 0x01, 0, 0, 0, 0)
+    FIRMWARE_LENGTH = 16
+
+    # The temperature/humidity query
+    DATA_QUERY = struct.pack('8B', 0x01, 0x80, 0x33, 0x01, 0, 0, 0, 0)
+
+    # The supported hidraw devices. If the firmware is not listed here, or the
+    # device returns less data than expected, the reply to the data query ends
+    # when the device goes idle.
+    DECODERS = DecoderRegistry([
+        Decoder('TEMPerF1.4', 10, 256.0, [
+            ('internal temperature', None),
+        ]),
+        Decoder('TEMPerGold_V3.', 15, 100.0, [
+            ('internal temperature', None),
+        ]),
+        Decoder('TEMPerX_V3.1', 12, 100.0, [
+            ('internal temperature', 'internal humidity'),
+            ('external temperature', 'external humidity'),
+        ]),
+        Decoder('TEMPerX_V3.3', 12, 100.0, [
+            ('internal temperature', 'internal humidity'),
+            ('external temperature', 'external humidity'),
+        ]),
+    ])
+
+    # When combining samples, values which differ from the median by more
+    # than this many times the median absolute deviation are discarded.
+    OUTLIER_LIMIT = 3
+
+    def __init__(self, device, verbose=False, session=None, reactor=None,
+                 pipeline=False, samples=1):
+        self.device = device
+        self.verbose = verbose
+        self.session = session
+        self.reactor = reactor
+        self.pipeline = pipeline
+        self.samples = samples
+
+    @property
+    def latency(self):
+        '''The session's LatencyEstimate, or None. It is looked up each time,
+        since the session replaces it when the device is reopened.
+        '''
+        if self.session is None:
+            return None
+        return self.session.latency
+
+    def _timeout(self, default):
+        '''Return how long to wait for the device, given the 'default'.
+        '''
+        if self.latency is None:
+            return default
+        return self.latency.timeout(default)
+
+    @staticmethod
+    def _is_firmware(report):
+        '''Return True if 'report' could be part of the firmware identifier.
+        '''
+        return not report[0] & 0x80
+
+    @staticmethod
+    def _is_data(report):
+        '''Return True if 'report' could be part of the reply to the data query.
+        '''
+        return bool(report[0] & 0x80)
+
+    def _transact(self, fd, command, length, timeout, buffer=None,
+                  match=None):
+        '''Write 'command' to 'fd' and return the reply. See Transaction for the
+        meaning of the other arguments; 'timeout' is only a default, see
+        '_timeout'.
+
+        If there is no reply at all after waiting less than the default, the
+        device is slower than its estimate says, so the command is sent again
+        and given the default time.
+        '''
+        learned = self._timeout(timeout)
+        reply = self._perform(Transaction(fd, command, length, learned, buffer,
+                                          match),
+                              self.latency)
+        if learned < timeout and not len(reply):
+            if self.verbose:
+                print('No reply within %.3fs; retrying' % learned)
+            reply = self._perform(Transaction(fd, command, length, timeout,
+                                              buffer, match),
+                                  self.latency)
+        return reply
+
+    def _perform(self, transaction, latency=None):
+        '''Perform 'transaction' and return its reply. If 'latency' is not None
+        then the time the device took to reply is added to it.
+        '''
+        if self.reactor is None:
+            reply = transaction.run()
+        else:
+            reply = self.reactor.submit(transaction).result()
+        if self.verbose and transaction.discarded:
+            print('Discarded %d bytes of stale input' % transaction.discarded)
+        if latency is not None:
+            # If nothing arrived, the device took at least the timeout. A
+            # reply shorter than 'length' is not counted this way, since
+            # some devices always send less than the most they can.
+            latency.add(transaction.timeout if transaction.latency is None
+                        else transaction.latency)
+        return reply
+
+    def _data_length(self, firmware):
+        '''Return the expected length of the reply to the data query for
+        'firmware', or None if it is not known.
+        '''
+        decoder = self.DECODERS.find(str(firmware, 'latin-1').strip())
+        return None if decoder is None else decoder.length
+
+    def _read_hidraw_firmware(self, fd, verbose=False, buffer=None):
         ''' Get firmware identifier'''
-        query = struct.pack('8B', 0x01, 0x86, 0xff, 0x01, 0, 0, 0, 0)
+        query = self.FIRMWARE_QUERY
         if verbose:
             print('Firmware query: %s' % binascii.b2a_hex(query))
 
@@ -146,52 +966,124 @@ class USBRead(object):
         # device.  We'll retry a few times and hope for the best.
         # See: https://github.com/urwen/temper/issues/9
         for i in range(0, 10):
-            os.write(fd, query)
-
-            firmware = b''
-            while True:
-                r, _, _ = select.select([fd], [], [], 0.2)
-                if fd not in r:
-                    break
-                data = os.read(fd, 8)
-                firmware += data
+            firmware = self._transact(fd, query, self.FIRMWARE_LENGTH, 0.2,
+                                      buffer, self._is_firmware)
 
             if not len(firmware):
-                os.close(fd)
                 raise RuntimeError('Cannot read device firmware identifier')
 
             if len(firmware) > 8:
                 break
 
+        # Copy the identifier out of the buffer, since it will be kept
+        firmware = bytes(firmware)
         if verbose:
             print('Firmware value: %s %s' %
                   (binascii.b2a_hex(firmware), firmware.decode()))
 
         return firmware
 
+    def _query_hidraw(self, session, fd):
+        '''Send the firmware and data queries to an open hidraw device and
+        return the raw replies to each. The firmware query is skipped if the
+        session already knows the firmware identifier. The data is returned as
+        a view of the session's buffer.
+        '''
+        firmware = session.firmware
+        if firmware is None and self.pipeline:
+            firmware, bytes = self._perform(PipelinedTransaction(
+                fd, [self.FIRMWARE_QUERY, self.DATA_QUERY],
+                self.FIRMWARE_LENGTH, self._data_length, self._timeout(0.2),
+                session.buffer), self.latency)
+            if self.verbose:
+                print('Firmware value (pipelined): %s' %
+                      binascii.b2a_hex(firmware))
+            if len(firmware) > 8:
+                session.firmware = firmware
+                return firmware, bytes
+            # The firmware reply was incomplete; fall back to asking for it
+            # on its own.
+            firmware = None
+        if firmware is None:
+            firmware = self._read_hidraw_firmware(fd, self.verbose,
+                                                  session.buffer)
+            session.firmware = firmware
+        elif self.verbose:
+            print('Firmware value (cached): %s' % binascii.b2a_hex(firmware))
+
+        # Get temperature/humidity
+        bytes = self._transact(fd, self.DATA_QUERY,
+                               self._data_length(firmware), 0.1,
+                               session.buffer, self._is_data)
+        return firmware, bytes
+
+    def _sample_hidraw(self, session, fd):
+        '''Query an open hidraw device as '_query_hidraw' does, then repeat the
+        data query until there are 'self.samples' replies. Return the firmware
+        identifier and a list of the replies to the data query.
+        '''
+        firmware, data = self._query_hidraw(session, fd)
+        if self.samples <= 1:
+            return firmware, [data]
+        # Each reply is copied out of the buffer before it is reused
+        replies = [bytes(data)]
+        length = self._data_length(firmware)
+        while len(replies) < self.samples:
+            data = self._transact(fd, self.DATA_QUERY, length, 0.1,
+                                  session.buffer, self._is_data)
+            if self.verbose:
+                print('Data value (sample %d): %s' %
+                      (len(replies) + 1, binascii.hexlify(data)))
+            replies.append(bytes(data))
+        return firmware, replies
+
+    def _combine(self, decoder, replies, info):
+        '''Decode each of 'replies' and replace the values in 'info' with ones
+        combined from all of them. Outliers are discarded, and the mean of the
+        remaining samples is reported. 'samples' is set to the number of
+        replies, and 'spread' to a dictionary of the range of the samples kept
+        for each value.
+        '''
+        values = collections.defaultdict(list)
+        for reply in replies:
+            sample = dict()
+            decoder.decode(reply, sample)
+            for name, value in sample.items():
+                values[name].append(value)
+
+        spread = dict()
+        for name, samples in values.items():
+            median = statistics.median(samples)
+            # The deviation is at least the resolution of the device, so that
+            # samples which differ by one step are never outliers.
+            deviation = max(statistics.median(abs(value - median)
+                                              for value in samples),
+                            1 / decoder.divisor)
+            kept = [value for value in samples
+                    if abs(value - median) <= self.OUTLIER_LIMIT * deviation]
+            info[name] = round(statistics.fmean(kept), 4)
+            spread[name] = round(max(kept) - min(kept), 4)
+        info['samples'] = len(replies)
+        info['spread'] = spread
+
     def _read_hidraw(self, device):
         '''Using the Linux hidraw device, send the special commands and receive the
-        raw data. Then call '_parse_bytes' based on the firmware version to provide
+        raw data. Then decode it according to the firmware version to provide
         temperature and humidity information.
 
         A dictionary of temperature and humidity info is returned.
         '''
-        path = os.path.join('/dev', device)
-        fd = os.open(path, os.O_RDWR)
-
-        firmware = self._read_hidraw_firmware(fd, self.verbose)
-
-        # Get temperature/humidity
-        os.write(fd, struct.pack('8B', 0x01, 0x80, 0x33, 0x01, 0, 0, 0, 0))
-        bytes = b''
-        while True:
-            r, _, _ = select.select([fd], [], [], 0.1)
-            if fd not in r:
-                break
-            data = os.read(fd, 8)
-            bytes += data
+        session = self.session
+        if session is None:
+            session = DeviceSession(None, device)
+        try:
+            firmware, replies = session.run(
+                lambda fd: self._sample_hidraw(session, fd))
+        finally:
+            if self.session is None:
+                session.close()
 
-        os.close(fd)
+        bytes = replies[0]
         if self.verbose:
             print('Data value: %s' % binascii.hexlify(bytes))
 
@@ -200,28 +1092,68 @@ class USBRead(object):
         info['hex_firmware'] = str(binascii.b2a_hex(firmware), 'latin-1')
         info['hex_data'] = str(binascii.b2a_hex(bytes), 'latin-1')
 
-        if info['firmware'][:10] == 'TEMPerF1.4':
-            info['firmware'] = info['firmware'][:10]
-            self._parse_bytes('internal temperature', 2, 256.0, bytes, info)
-            return info
-
-        if info['firmware'][:14] == 'TEMPerGold_V3.':
-            info['firmware'] = info['firmware'][:15]
-            self._parse_bytes('internal temperature', 2, 100.0, bytes, info)
-            return info
-
-        if info['firmware'][:12] in ['TEMPerX_V3.1', 'TEMPerX_V3.3']:
-            info['firmware'] = info['firmware'][:12]
-            self._parse_bytes('internal temperature', 2, 100.0, bytes, info)
-            self._parse_bytes('internal humidity', 4, 100.0, bytes, info)
-            self._parse_bytes('external temperature', 10, 100.0, bytes, info)
-            self._parse_bytes('external humidity', 12, 100.0, bytes, info)
+        # With the firmware identifier cached, this is the only sign of
+        # whether the device is answering. A device with only some of its
+        # sensors may return fewer frames than the decoder allows for.
+        decoder = self.DECODERS.find(info['firmware'])
+        if len(bytes) < (1 if decoder is None else decoder.FRAME.size):
+            raise RuntimeError('No data from device')
+        if decoder is not None:
+            info['firmware'] = info['firmware'][:decoder.name_length]
+            decoder.decode(bytes, info)
+            if len(replies) > 1:
+                self._combine(decoder, replies, info)
             return info
 
         info['error'] = 'Unknown firmware %s: %s' % (info['firmware'],
                                                      binascii.hexlify(bytes))
         return info
 
+    # Replies to serial commands. A reply to "Version" is one line; a reply
+    # to "ReadTemp" has a Temp-Inner line, and usually a Temp-Outer line.
+    VERSION_REPLY = re.compile(rb'\S[^\r\n]*\r?\n')
+    READTEMP_REPLY = re.compile(rb'Temp-Outer:[^\r\n]*\r?\n')
+    READTEMP_PARTIAL = re.compile(rb'Temp-Inner:[^\r\n]*\r?\n')
+
+    # Values within a "ReadTemp" reply
+    TEMP_INNER = re.compile(r'Temp-Inner:(-?[0-9.]+) ?\[C\]'
+                            r'(?:, ?(-?[0-9.]+) ?\[%RH\])?')
+    TEMP_OUTER = re.compile(r'Temp-Outer:(-?[0-9.]+) ?\[C\]')
+
+    # The time allowed for the reply to each serial command, in seconds
+    SERIAL_TIMEOUT = 1
+
+    def _query_serial(self, session, fd):
+        '''Send the "Version" and "ReadTemp" commands to an open serial device
+        and return the replies to each, as strings. The "Version" command is
+        skipped if the session already knows the firmware identifier.
+        '''
+        # Discard anything the device sent unprompted. termios.error is not an
+        # OSError, so convert it, so that a hung-up tty is reopened.
+        try:
+            termios.tcflush(fd, termios.TCIFLUSH)
+        except termios.error as e:
+            raise OSError(*e.args)
+
+        # Send the "Version" command and save the reply, unless it's already
+        # known.
+        firmware = session.firmware
+        if firmware is None:
+            reply = self._perform(SerialTransaction(
+                fd, b'Version', self.VERSION_REPLY, self.SERIAL_TIMEOUT,
+                session.buffer))
+            firmware = str(reply, 'latin-1').strip()
+            if firmware:
+                session.firmware = firmware
+
+        # Send the "ReadTemp" command and save the reply.
+        reply = self._perform(SerialTransaction(
+            fd, b'ReadTemp', self.READTEMP_REPLY, self.SERIAL_TIMEOUT,
+            session.buffer, self.READTEMP_PARTIAL))
+        if not len(reply):
+            raise RuntimeError('No data from device')
+        return firmware, str(reply, 'latin-1')
+
     def _read_serial(self, device):
         '''Using the Linux serial device, send the special commands and receive the
         text data, which is parsed directly in this method.
@@ -229,42 +1161,37 @@ class USBRead(object):
         A dictionary of device info (like that returned by USBList) combined with
         temperature and humidity info is returned.
         '''
-
-        path = os.path.join('/dev', device)
-        s = serial.Serial(path, 9600)
-        s.bytesize = serial.EIGHTBITS
-        s.parity = serial.PARITY_NONE
-        s.stopbits = serial.STOPBITS_ONE
-        s.timeout = 1
-        s.xonoff = False
-        s.rtscts = False
-        s.dsrdtr = False
-        s.writeTimeout = 0
-
-        # Send the "Version" command and save the reply.
-        s.write(b'Version')
-        firmware = str(s.readline(), 'latin-1').strip()
-
-        # Send the "ReadTemp" command and save the reply.
-        s.write(b'ReadTemp')
-        reply = str(s.readline(), 'latin-1').strip()
-        reply += str(s.readline(), 'latin-1').strip()
-        s.close()
+        session = self.session
+        if session is None:
+            session = DeviceSession(None, device)
+        try:
+            firmware, reply = session.run(
+                lambda fd: self._query_serial(session, fd))
+        finally:
+            if self.session is None:
+                session.close()
 
         info = dict()
         info['firmware'] = firmware
-        m = re.search(r'Temp-Inner:([0-9.]*).*, ?([0-9.]*)', reply)
-        if m is not None:
-            info['internal temperature'] = float(m.group(1))
-            info['internal humidity'] = float(m.group(2))
-        m = re.search(r'Temp-Outer:([0-9.]*)', reply)
-        if m is not None:
-            try:
-                info['external temperature'] = float(m.group(1))
-            except:
-                pass
+        self._parse_serial(reply, info)
         return info
 
+    def _parse_serial(self, reply, info):
+        '''Parse the reply to "ReadTemp" and add the values found to 'info'. A
+        sensor which is not present is reported as "--" and is skipped.
+        '''
+        try:
+            m = self.TEMP_INNER.search(reply)
+            if m is not None:
+                info['internal temperature'] = float(m.group(1))
+                if m.group(2) is not None:
+                    info['internal humidity'] = float(m.group(2))
+            m = self.TEMP_OUTER.search(reply)
+            if m is not None:
+                info['external temperature'] = float(m.group(1))
+        except ValueError:
+            pass
+
     def read(self):
         '''Read the firmware version, temperature, and humidity from the device and
         return a dictionary containing these data.
@@ -277,19 +1204,460 @@ class USBRead(object):
         return {'error': 'No usable hid/tty devices available'}
 
 
+class USBStream(object):
+    '''A serial device which reports readings by itself, rather than being
+    asked for them. The TEMPerX232, for instance, can be switched to send a
+    line such as "30.48 [C]40.19 [%RH]1" every second.
+
+    The device is kept open and its output is parsed by the reactor thread as
+    it arrives; 'read' returns the most recent reading. No commands are sent.
+    Once the device goes away (or 'stop' is called) the stream is finished,
+    and a new stream must be started to read the device again.
+    '''
+
+    # A value in a reading line. The first temperature is the internal one,
+    # and a second temperature is from the external sensor.
+    VALUE = re.compile(rb'(-?[0-9]+\.[0-9]+) ?\[(C|%RH)\]', re.IGNORECASE)
+    # A line naming the firmware, which is sent when reporting starts
+    FIRMWARE = re.compile(rb'\s*(TEMPer\S*)\s*$', re.IGNORECASE)
+
+    # Readings are sent every second; one older than this many seconds means
+    # the device has stopped reporting.
+    MAX_AGE = 5
+
+    def __init__(self, device, reactor, busnum=None, devnum=None):
+        self.device = device
+        self.identity = (device, busnum, devnum)
+        self.reactor = reactor
+        self.session = DeviceSession(None, device, busnum, devnum)
+        self.fd = None
+        self.firmware = None
+        self.reading = None
+        self.error = None
+        self.finished = False
+        # Set once the first reading has arrived
+        self.ready = threading.Event()
+        # Lines are assembled in this
+        self.buffer = bytearray(DeviceSession.BUFFER_SIZE)
+        self.size = 0
+
+    def start(self):
+        '''Open the device and start listening to it.
+        '''
+        self.fd = self.session.fileno()
+        try:
+            termios.tcflush(self.fd, termios.TCIFLUSH)
+        except termios.error as e:
+            self.session.discard()
+            raise OSError(*e.args)
+        self.reactor.listen(self)
+        return self
+
+    def stop(self):
+        '''Stop listening to the device and close it.
+        '''
+        self.reactor.unlisten(self)
+
+    def close(self):
+        # Called by the reactor thread
+        self.session.discard()
+        self.finished = True
+        self.ready.set()
+
+    def readable(self):
+        # Called by the reactor thread when data has arrived
+        with memoryview(self.buffer) as view:
+            n = os.readv(self.fd, [view[self.size:]])
+        if n == 0:
+            raise OSError(errno.EIO, 'Device has gone away', self.device)
+        self.size += n
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start, self.size)
+            if end < 0:
+                break
+            self._parse(bytes(self.buffer[start:end]))
+            start = end + 1
+        if start == 0 and self.size == len(self.buffer):
+            # No line ending in sight; start again
+            self.size = 0
+        elif start:
+            self.buffer[:self.size - start] = self.buffer[start:self.size]
+            self.size -= start
+
+    def _parse(self, line):
+        m = self.FIRMWARE.match(line)
+        if m is not None:
+            self.firmware = str(m.group(1), 'latin-1')
+            return
+        temperatures = []
+        humidities = []
+        for value, unit in self.VALUE.findall(line):
+            if unit == b'C' or unit == b'c':
+                temperatures.append(float(value))
+            else:
+                humidities.append(float(value))
+        if not temperatures:
+            return
+        reading = {'timestamp': time.time()}
+        if self.firmware is not None:
+            reading['firmware'] = self.firmware
+        reading['internal temperature'] = temperatures[0]
+        if humidities:
+            reading['internal humidity'] = humidities[0]
+        if len(temperatures) > 1:
+            reading['external temperature'] = temperatures[1]
+        self.reading = reading
+        self.ready.set()
+
+    def read(self, timeout):
+        '''Return the most recent reading, waiting up to 'timeout' seconds for
+        the first one. The 'timestamp' field records when the reading arrived.
+        If the most recent reading is more than MAX_AGE seconds old, the device
+        is taken to have stopped reporting, and RuntimeError is raised.
+        '''
+        self.ready.wait(timeout)
+        reading = self.reading
+        if reading is None:
+            if self.error is not None:
+                raise OSError(errno.EIO, self.error, self.device)
+            raise RuntimeError('no reading received from device')
+        if time.time() - reading['timestamp'] > self.MAX_AGE:
+            raise RuntimeError('no recent reading')
+        return reading
+
+
+class DeviceWatcher(object):
+    '''Watch for USB devices, and their hidraw and tty devices, coming and
+    going, and apply the changes to a Temper's device map as they happen.
+
+    Kernel uevents are received over netlink. If that is not available (e.g.
+    because the service is not allowed netlink sockets) then /dev is watched
+    with inotify instead.
+    '''
+
+    NETLINK_KOBJECT_UEVENT = 15
+
+    # inotify(7) constants
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+
+    # How long to wait for a burst of events to finish, in seconds
+    SETTLE = 0.5
+
+    def __init__(self, temper):
+        self.temper = temper
+
+    def start(self):
+        '''Start watching in a background thread. Returns the thread, or None if
+        neither netlink nor inotify is available.
+        '''
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                 self.NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))
+            target = lambda: self._watch(sock.fileno(), self._read_netlink)
+        except (OSError, AttributeError):
+            fd = self._inotify('/dev')
+            if fd is None:
+                return None
+            target = lambda: self._watch(fd, self._read_inotify)
+        thread = threading.Thread(target=target, name='watcher', daemon=True)
+        thread.start()
+        return thread
+
+    def _inotify(self, path):
+        # Return an inotify descriptor watching 'path', or None
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(path),
+                                  self.IN_CREATE | self.IN_DELETE) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def _watch(self, fd, parse):
+        # Collect the paths of affected USB devices from 'fd' until things have
+        # settled down, then update the device map.
+        # If this stops, the sampler goes back to rescanning once a minute.
+        from traceback import print_exc
+        pending = set()
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(fd, selectors.EVENT_READ)
+                while True:
+                    if selector.select(self.SETTLE if pending else None):
+                        try:
+                            pending |= parse(os.read(fd, 65536))
+                        except OSError:
+                            # e.g. ENOBUFS, when netlink events have been
+                            # lost; rescan everything.
+                            pending.add(None)
+                        continue
+                    try:
+                        self.temper.update(pending)
+                    except Exception:
+                        print_exc()
+                    pending = set()
+        finally:
+            self.temper.watching = False
+
+    def _usb_device_path(self, devpath):
+        '''Return the /sys/bus/usb/devices path of the USB device that 'devpath'
+        (a path under /sys) belongs to, or None.
+        '''
+        name = USBList()._usb_device_name(devpath)
+        if name is None:
+            return None
+        return os.path.join(Temper.SYSPATH, name)
+
+    def _read_netlink(self, data):
+        # Parse a uevent message, returning the affected USB device paths
+        fields = dict()
+        for field in data.split(b'\0')[1:]:
+            key, _, value = field.partition(b'=')
+            fields[key] = str(value, 'latin-1')
+        if fields.get(b'SUBSYSTEM') not in ('usb', 'hidraw', 'tty'):
+            return set()
+        path = self._usb_device_path(fields.get(b'DEVPATH', ''))
+        return set() if path is None else {path}
+
+    def _read_inotify(self, data):
+        # Parse inotify events, returning the affected USB device paths. A
+        # new node is found through /sys/class; a removed one through the
+        # current device map. If neither works, None stands for 'everything'.
+        paths = set()
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            name = str(name, 'latin-1')
+            if name.startswith('hidraw'):
+                subsystem = 'hidraw'
+            elif name.startswith('tty'):
+                subsystem = 'tty'
+            else:
+                continue
+            path = self._usb_device_path(os.path.realpath(
+                os.path.join(USBList.CLASSPATH, subsystem, name)))
+            if path is None:
+                for device_path, info in self.temper.usb_devices.items():
+                    if name in info['devices']:
+                        path = device_path
+            paths.add(path)
+        return paths
+
+
+class DeviceRegistry(object):
+    '''An immutable index of a device map, as returned by USBList. The devices
+    are kept in bus/device order, and can be looked up by vendor and product
+    id, or by port. The port is the name of the device in /sys (e.g.
+    "1-1.2"), which reflects where it is plugged in, so it tells identical
+    devices apart and stays the same when a device is re-enumerated.
+    '''
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.order = sorted(devices.items(),
+                            key=lambda x: x[1]['busnum'] * 1000 +
+                            x[1]['devnum'])
+        self.by_port = dict()
+        self.by_id = dict()
+        for path, info in self.order:
+            self.by_port[self.port(path)] = (path, info)
+            self.by_id.setdefault((info['vendorid'], info['productid']),
+                                  (path, info))
+
+    def port(self, path):
+        '''Return the port of the device at 'path'.
+        '''
+        return os.path.basename(path)
+
+    def find_port(self, port):
+        '''Return (path, info) for the device at 'port', or None.
+        '''
+        return self.by_port.get(port)
+
+    def find_id(self, vendorid, productid):
+        '''Return (path, info) for the first device with the given vendor and
+        product ids, in bus/device order, or None.
+        '''
+        return self.by_id.get((vendorid, productid))
+
+
 class Temper(object):
     SYSPATH = '/sys/bus/usb/devices'
 
-    def __init__(self, verbose=False):
+    # The maximum number of devices read at once
+    MAX_WORKERS = 8
+
+    # The values a reading can provide
+    VALUES = ('internal temperature', 'internal humidity',
+              'external temperature', 'external humidity')
+
+    def __init__(self, verbose=False, cache=False):
         self.forced_vendor_id = None
         self.forced_product_id = None
         self.verbose = verbose
-        self.reset()
+        # Where the device map is cached between runs, if anywhere
+        self.cache_path = self._cache_path() if cache else None
+        self.cached = False
+        self.readings = {}
+        # Serializes changes to the snapshot of readings
+        self.readings_lock = threading.Lock()
+        # Serializes changes to the device map
+        self.update_lock = threading.Lock()
+        # True if a DeviceWatcher is keeping the device map up to date
+        self.watching = False
+        # Serializes calls to 'sample'. Reads of individual devices are
+        # serialized by their session locks.
+        self.lock = threading.Lock()
+        self.sessions = SessionPool()
+        self.reactor = Reactor()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            self.MAX_WORKERS, thread_name_prefix='read')
+        # How long to wait for each device to answer, in seconds
+        self.timeout = 5
+        # Whether to pipeline the firmware and data queries
+        self.pipeline = False
+        # How many samples to take from each hidraw device per reading, and
+        # exceptions to that, indexed by port
+        self.samples = 1
+        self.port_samples = dict()
+        # The ports of serial devices which report readings by themselves,
+        # and their streams, indexed by path
+        self.stream_ports = set()
+        self.streams = dict()
+        self.streams_lock = threading.Lock()
+        if not self.load_cache():
+            self.reset()
+
+    @property
+    def usb_devices(self):
+        '''The device map, as returned by USBList.
+        '''
+        return self.registry.devices
 
-    def reset(self):
+    @usb_devices.setter
+    def usb_devices(self, usb_devices):
+        # Replacing the map replaces the registry in a single step
+        self.registry = DeviceRegistry(usb_devices)
+
+    def reset(self, all_devices=False):
+        '''Rebuild the device map. Unless 'all_devices' is True, only devices
+        with known ids are included.
+        '''
+        # The device map is never modified in place, only replaced, so other
+        # threads can use it without locking.
         usblist = USBList()
-        self.usb_devices = usblist.get_usb_devices()
+        is_known = None if all_devices else self._is_known_id
+        key = self._cache_key()
+        with self.update_lock:
+            self.usb_devices = usblist.get_usb_devices(is_known)
+        self.sessions.prune(self.usb_devices)
         self.last_reset = os.times().elapsed
+        self.cached = False
+        if not all_devices:
+            self.save_cache(key)
+
+    def _cache_path(self):
+        # Follow the XDG base directory specification
+        cache_home = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(cache_home, 'temper', 'devices.json')
+
+    def _cache_key(self):
+        '''Return a cheap summary of the attached devices: the USB device nodes
+        (which change whenever a device is added, removed or re-enumerated)
+        and the hidraw and tty nodes. Returns None if it cannot be determined.
+        '''
+        try:
+            nodes = []
+            for bus in sorted(os.listdir('/dev/bus/usb')):
+                for dev in sorted(os.listdir(os.path.join('/dev/bus/usb', bus))):
+                    nodes.append(bus + '/' + dev)
+            nodes += sorted(name for name in os.listdir('/dev')
+                            if name.startswith('hidraw') or
+                            name.startswith('tty'))
+            return nodes
+        except OSError:
+            return None
+
+    def load_cache(self):
+        '''Load the device map from the cache, if it is enabled and still
+        matches the attached devices. Returns True on success.
+        '''
+        if self.cache_path is None:
+            return False
+        key = self._cache_key()
+        if key is None:
+            return False
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if cache.get('key') != key or \
+           cache.get('forced') != [self.forced_vendor_id, self.forced_product_id]:
+            return False
+        self.usb_devices = cache['usb_devices']
+        self.last_reset = os.times().elapsed
+        self.cached = True
+        return True
+
+    def save_cache(self, key):
+        '''Save the device map to the cache, if it is enabled. 'key' is the
+        value of '_cache_key' from before the map was built.
+        '''
+        if self.cache_path is None or key is None:
+            return
+        cache = {
+            'key': key,
+            'forced': [self.forced_vendor_id, self.forced_product_id],
+            'usb_devices': self.usb_devices,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp = self.cache_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp, self.cache_path)
+        except OSError:
+            pass
+
+    def update(self, paths):
+        '''Re-examine the USB devices at 'paths' and update the device map,
+        adding, replacing or removing their entries. None in 'paths' means
+        that the whole map must be rebuilt.
+        '''
+        if None in paths:
+            self.reset()
+            return
+        usblist = USBList()
+        with self.update_lock:
+            usb_devices = dict(self.usb_devices)
+            class_devices = usblist.get_class_devices()
+            for path in paths:
+                try:
+                    info = usblist.get_usb_device(path, self._is_known_id,
+                                                  class_devices)
+                except (OSError, ValueError):
+                    # The device went away while we were looking at it
+                    info = None
+                if info is None:
+                    usb_devices.pop(path, None)
+                else:
+                    usb_devices[path] = info
+            self.usb_devices = usb_devices
+        self.sessions.prune(usb_devices)
 
     def _is_known_id(self, vendorid, productid):
         '''Returns True if the vendorid and product id are valid.
@@ -321,9 +1689,7 @@ class Temper(object):
             print(json.dumps(self.usb_devices, indent=4))
             return
 
-        for _, info in sorted(self.usb_devices.items(),
-                              key=lambda x: x[1]['busnum'] * 1000 +
-                              x[1]['devnum']):
+        for _, info in self.registry.order:
             print('Bus %03d Dev %03d %04x:%04x %s %s %s' % (
                 info['busnum'],
                 info['devnum'],
@@ -339,22 +1705,229 @@ class Temper(object):
         dictionaries which contain the device information, firmware information,
         and environmental information obtained. If there is an error, then the
         'error' field in the dictionary will contain a string explaining the
-        error.
+        error. The 'timestamp' field records when the device was read.
         '''
-        results = []
-        for _, info in sorted(self.usb_devices.items(),
-                              key=lambda x: x[1]['busnum'] * 1000 +
-                              x[1]['devnum']):
+        # The devices are read concurrently, but the results are returned in
+        # bus/device order.
+        futures = []
+        for path, info in self.registry.order:
             if not self._is_known_id(info['vendorid'], info['productid']):
                 continue
-            if len(info['devices']) == 0:
-                info['error'] = 'no hid/tty devices available'
-                results.append(info)
-                continue
-            usbread = USBRead(info['devices'][-1], verbose)
-            results.append({**info, **usbread.read()})
+            futures.append((path, info, self.executor.submit(
+                self._read_device, path, info, verbose)))
+
+        results = []
+        deadline = time.monotonic() + self.timeout
+        for path, info, future in futures:
+            try:
+                results.append(future.result(
+                    max(0, deadline - time.monotonic())))
+            except concurrent.futures.TimeoutError:
+                results.append({**info, 'path': path, 'timestamp': time.time(),
+                                'error': 'timed out'})
         return results
 
+    def _read_device(self, path, info, verbose=False, probe=False):
+        '''Read a single device and return a dictionary which combines 'info'
+        with the information obtained. If the device is already being read,
+        wait for that read and share its result. If the device is still busy
+        after 'self.timeout' seconds, an error is returned instead.
+
+        Errors are reported in the 'error' field rather than raised. If the
+        device node has gone away, just this device's entry in the device map
+        is re-examined, and the result is marked 'degraded'.
+
+        A device which keeps failing is quarantined (see CircuitBreaker), and
+        is not read unless 'probe' is True; a "quarantined" error is returned
+        straight away instead. Probes are made in the background.
+        '''
+        if len(info['devices']) == 0:
+            return {**info, 'path': path, 'timestamp': time.time(),
+                    'error': 'no hid/tty devices available'}
+        session = self.sessions.get(path, info)
+        breaker = session.breaker
+        if breaker.open and not probe:
+            if breaker.probe():
+                self.executor.submit(self._probe, path, info)
+            return {**info, 'path': path, 'timestamp': time.time(),
+                    'error': 'quarantined'}
+
+        def read():
+            if not session.lock.acquire(timeout=self.timeout):
+                return {**info, 'path': path, 'timestamp': time.time(),
+                        'error': 'device busy'}
+            try:
+                stream = self._get_stream(path, info)
+                if stream is not None:
+                    reading = stream.read(self.timeout)
+                else:
+                    samples = self.port_samples.get(self.registry.port(path),
+                                                    self.samples)
+                    usbread = USBRead(info['devices'][-1], verbose, session,
+                                      self.reactor, self.pipeline, samples)
+                    reading = usbread.read()
+                if 'error' in reading or any(name in reading
+                                             for name in self.VALUES):
+                    breaker.succeeded()
+                else:
+                    # The device answered, but with nothing
+                    breaker.failed()
+                return {**info, 'path': path, 'timestamp': time.time(),
+                        **reading}
+            except RuntimeError as e:
+                breaker.failed()
+                return {**info, 'path': path, 'timestamp': time.time(),
+                        'error': str(e)}
+            except OSError as e:
+                breaker.failed()
+                error = e
+            finally:
+                session.lock.release()
+            # The session lock must be released first, since a changed
+            # device will have its session discarded.
+            self.update({path})
+            return {**info, 'path': path, 'timestamp': time.time(),
+                    'error': str(error), 'degraded': True}
+
+        try:
+            return session.shared(read, self.timeout)
+        except concurrent.futures.TimeoutError:
+            return {**info, 'path': path, 'timestamp': time.time(),
+                    'error': 'device busy'}
+
+    def _probe(self, path, info):
+        '''Read a quarantined device to see whether it has recovered. If it has,
+        the reading is published.
+        '''
+        reading = self._read_device(path, info, probe=True)
+        if 'error' not in reading:
+            self._publish([reading])
+
+    def _get_stream(self, path, info):
+        '''Return the USBStream for the device at 'path', starting it if need be,
+        or None if the device is not one which reports readings by itself.
+        '''
+        device = info['devices'][-1]
+        if (not device.startswith('tty') or
+                self.registry.port(path) not in self.stream_ports):
+            return None
+        identity = (device, info['busnum'], info['devnum'])
+        with self.streams_lock:
+            stream = self.streams.get(path)
+            if (stream is not None and not stream.finished and
+                    stream.identity == identity):
+                return stream
+            if stream is not None:
+                stream.stop()
+            stream = USBStream(device, self.reactor, info['busnum'],
+                               info['devnum'])
+            self.streams[path] = stream.start()
+            return stream
+
+    def sample(self, verbose=False):
+        '''Read all of the known devices and publish the results as the current
+        snapshot in 'self.readings', a dictionary indexed by path. The snapshot
+        is replaced as a whole, so readers never see a partial update. Devices
+        not read are dropped from it, but a reading published while the
+        devices were being read (e.g. by a probe) is kept if it is newer.
+        '''
+        with self.lock:
+            results = self.read(verbose)
+        with self.readings_lock:
+            readings = self.readings
+            self.readings = {info['path']: self._newer(
+                info, readings.get(info['path'])) for info in results}
+        return results
+
+    def _publish(self, readings):
+        '''Merge a list of fresh readings into the snapshot. A reading older
+        than the one already there is ignored.
+        '''
+        with self.readings_lock:
+            merged = dict(self.readings)
+            for info in readings:
+                merged[info['path']] = self._newer(info,
+                                                   merged.get(info['path']))
+            self.readings = merged
+
+    @staticmethod
+    def _newer(reading, other):
+        # Return whichever of two readings was taken later
+        if other is not None and other['timestamp'] > reading['timestamp']:
+            return other
+        return reading
+
+    def get_readings(self, max_age=None, timeout=None):
+        '''Return the readings from the snapshot as a list. If 'max_age' is not
+        None, then any reading more than 'max_age' seconds old is replaced by a
+        fresh one, read from the device, and the snapshot is updated.
+
+        If 'timeout' is not None, then fresh readings are only waited for
+        that many seconds. A device which has not answered by then is reported
+        with its old reading, marked 'pending'; the fresh reading is added to
+        the snapshot when it arrives.
+        '''
+        readings = self.readings
+        if max_age is None:
+            return list(readings.values())
+        # Refresh stale readings concurrently
+        now = time.time()
+        usb_devices = self.usb_devices
+        futures = dict()
+        for path, reading in readings.items():
+            if now - reading['timestamp'] > max_age and path in usb_devices:
+                future = self.executor.submit(
+                    self._read_device, path, usb_devices[path])
+                future.add_done_callback(
+                    lambda future: self._publish([future.result()]))
+                futures[path] = future
+        concurrent.futures.wait(futures.values(), timeout)
+        results = []
+        for path, reading in readings.items():
+            future = futures.get(path)
+            if future is None:
+                results.append(reading)
+            elif future.done():
+                results.append(future.result())
+            else:
+                results.append({**reading, 'pending': True})
+        return results
+
+    def get_reading(self, path, info, max_age=None):
+        '''Return the reading for the device at 'path' from the snapshot. If
+        there is none, or 'max_age' is not None and the reading is more than
+        'max_age' seconds old, then the device is read and the snapshot is
+        updated.
+        '''
+        reading = self.readings.get(path)
+        if reading is None or (max_age is not None and
+                               time.time() - reading['timestamp'] > max_age):
+            reading = self._read_device(path, info)
+            self._publish([reading])
+        return reading
+
+    def start_sampler(self, interval):
+        '''Start a background thread that samples all of the known devices every
+        'interval' seconds. The first sample is taken before returning, so the
+        snapshot is populated by the time any request is served.
+        '''
+        from traceback import print_exc
+
+        def sampler():
+            while True:
+                time.sleep(interval)
+                try:
+                    if not self.watching:
+                        self.maybe_reset()
+                    self.sample()
+                except Exception:
+                    print_exc()
+
+        self.sample()
+        thread = threading.Thread(target=sampler, name='sampler', daemon=True)
+        thread.start()
+        return thread
+
     def _add_temperature(self, name, info):
         '''Helper method to add the temperature to a string in both Celsius and
         Fahrenheit. If no sensor data is available, then '- -' will be returned.
@@ -406,10 +1979,8 @@ class Temper(object):
 
     def webserver(self, server_config_path, logging=True):
         from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
-        from threading import Lock
-        from traceback import print_exc
+        from urllib.parse import urlsplit, parse_qs
         import stat
-        import socket
 
         with open(server_config_path) as f:
             server_config = json.load(f)
@@ -433,8 +2004,25 @@ class Temper(object):
             address = inherited_socket.getsockname()
 
         path_pattern = re.compile('^/([0-9]+)/([0-9]+)$')
-        self.lock = Lock()
+        port_pattern = re.compile('^/([0-9]+-[0-9.]+)$')
         self.last_reset = os.times().elapsed
+        # Devices are read in the background; requests are answered from the
+        # most recent snapshot.
+        self.timeout = server_config.get('timeout', self.timeout)
+        self.pipeline = server_config.get('pipeline', self.pipeline)
+        self.stream_ports = set(server_config.get('stream', ()))
+        # How long to wait for fresh readings when answering a request for
+        # all devices, in seconds, if the request does not say
+        request_timeout = server_config.get('timeout_ms')
+        if request_timeout is not None:
+            request_timeout /= 1000
+        samples = server_config.get('samples', self.samples)
+        if isinstance(samples, dict):
+            self.port_samples = samples
+        else:
+            self.samples = samples
+        self.watching = DeviceWatcher(self).start() is not None
+        self.start_sampler(server_config.get('interval', 10))
 
         class RequestHandler(BaseHTTPRequestHandler):
             protocol_version = 'HTTP/1.1'
@@ -458,68 +2046,79 @@ class Temper(object):
 
             def get_path(rqh, mode):
                 # handle any request, returning STATUS,BODY
-                with self.lock:
-                    match = path_pattern.match(rqh.path)
-                    if match:
-                        return rqh.get_device(mode, match)
-                    if rqh.path == "/devices":
-                        return rqh.get_devices(mode)
-                    if rqh.path == "/":
-                        return rqh.get_all(mode)
+                url = urlsplit(rqh.path)
+                query = parse_qs(url.query)
+                max_age = None
+                if 'max_age' in query:
+                    try:
+                        max_age = float(query['max_age'][-1])
+                    except ValueError:
+                        return 400, {'error': 'invalid max_age'}
+                timeout = request_timeout
+                if 'timeout_ms' in query:
+                    try:
+                        timeout = max(0, float(query['timeout_ms'][-1])) / 1000
+                    except ValueError:
+                        return 400, {'error': 'invalid timeout_ms'}
+                match = path_pattern.match(url.path)
+                if match:
+                    return rqh.get_device(mode, self.registry.find_id(
+                        int(match.group(1)), int(match.group(2))), max_age)
+                match = port_pattern.match(url.path)
+                if match:
+                    return rqh.get_device(mode, self.registry.find_port(
+                        match.group(1)), max_age)
+                if url.path == "/devices":
+                    return rqh.get_devices(mode)
+                if url.path == "/":
+                    return rqh.get_all(mode, max_age, timeout)
                 return 404, {'error': 'unrecognized path'}
 
             def get_devices(rqh, mode):
                 # Handle a /devices request
-                self.maybe_reset()
                 results = []
-                for _, info in self.usb_devices.items():
+                for path, info in self.registry.order:
                     # Skip irrelevant devices
                     if not self._is_known_id(info['vendorid'], info['productid']):
                         continue
                     # Return device identification information but skip bus information
-                    results.append(rqh.filter(info))
+                    results.append(rqh.filter({**info, 'path': path}))
                 return 200, results
 
-            def get_all(rqh, mode):
+            def get_all(rqh, mode, max_age, timeout):
                 # Handle a / request
-                self.maybe_reset()
                 if mode == 'HEAD':  # don't query devices just for HEAD
                     return 200, []
-                results = None
-                try:
-                    results = [rqh.filter(data) for data in self.read(False)]
-                except FileNotFoundError:
-                    print_exc()
-                if results is None:
-                    self.force_reset()
-                    results = [rqh.filter(data) for data in self.read(False)]
-                return 200, results
-
-            def get_device(rqh, mode, match):
-                # Handle a request to a single device
-                vendorid = int(match.group(1))
-                productid = int(match.group(2))
-                try:
-                    for _, info in self.usb_devices.items():
-                        if not self._is_known_id(info['vendorid'], info['productid']):
-                            continue
-                        if vendorid == info['vendorid'] and productid == info['productid']:
-                            if mode == 'HEAD':  # don't query device just for HEAD
-                                return 200, {}
-                            usbread = USBRead(info['devices'][-1], False)
-                            return 200, rqh.filter({**info, **usbread.read()})
-                except FileNotFoundError:
-                    print_exc()
-                self.maybe_reset()
+                return 200, [rqh.filter(data)
+                             for data in self.get_readings(max_age, timeout)]
+
+            def get_device(rqh, mode, found, max_age):
+                # Handle a request to a single device, found in the registry
+                if found is not None:
+                    path, info = found
+                    if self._is_known_id(info['vendorid'], info['productid']):
+                        if mode == 'HEAD':  # don't query device just for HEAD
+                            return 200, {}
+                        return 200, rqh.filter(
+                            self.get_reading(path, info, max_age))
                 return 404, {'error': 'no such device'}
 
             def filter(rqh, info):
                 filtered = {}
-                for k in ['vendorid', 'productid', 'manufacturer', 'product', 'internal temperature', 'internal humidity', 'external temperature', 'external humidity']:
+                for k in ['vendorid', 'productid', 'manufacturer', 'product', 'internal temperature', 'internal humidity', 'external temperature', 'external humidity', 'error', 'degraded', 'pending', 'samples', 'spread']:
                     if k in info:
                         filtered[k] = info[k]
                     # Provide a stable URL for this device
                     filtered['url'] = f'{protocol}://{server_config["hostname"]}:{server_config["port"]}/{info["vendorid"]}/{info["productid"]}'
+                # ...and one that tells identical devices apart
+                if 'path' in info:
+                    port = self.registry.port(info['path'])
+                    filtered['port'] = port
+                    filtered['port_url'] = f'{protocol}://{server_config["hostname"]}:{server_config["port"]}/{port}'
+                # Report when readings were taken
+                if 'timestamp' in info:
+                    filtered['timestamp'] = info['timestamp']
+                    filtered['age'] = round(time.time() - info['timestamp'], 3)
                 return filtered
 
             def log_request(self, code='-', size='-'):
@@ -572,14 +2171,22 @@ class Temper(object):
                             help='Output binary data from thermometer')
         parser.add_argument('--logging', action='store_true',
                             help='Log HTTP requests')
+        parser.add_argument('--pipeline', action='store_true',
+                            help='Send firmware and data queries together')
+        parser.add_argument('--samples', type=int, default=1,
+                            help='Combine several readings from each device',
+                            metavar='N')
         args = parser.parse_args()
         self.verbose = args.verbose
+        self.pipeline = args.pipeline
+        self.samples = args.samples
 
         if args.server:
             self.webserver(args.server, logging=args.logging)
             return
 
         if args.list:
+            self.reset(all_devices=True)
             self.list(args.json)
             return 0
 
@@ -596,13 +2203,19 @@ class Temper(object):
                 return 1
             self.forced_vendor_id = vendor_id
             self.forced_product_id = product_id
+            if not self.load_cache():
+                self.reset()
 
         # By default, output the temperature and humidity for all known sensors.
-        results = self.read(args.verbose)
-        self.print(results, args.json)
+        results = self.sample(args.verbose)
+        if self.cached and any('degraded' in info for info in results):
+            # The cached device map was out of date
+            self.reset()
+            self.sample(args.verbose)
+        self.print(list(self.readings.values()), args.json)
         return 0
 
 
 if __name__ == "__main__":
-    temper = Temper()
+    temper = Temper(cache=True)
     sys.exit(temper.main())